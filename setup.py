@@ -1,11 +1,11 @@
-import os
+import pathlib
 import unittest
 
 from setuptools import setup
 
 
 def read(fname):
-  return open(os.path.join(os.path.dirname(__file__), fname)).read()
+  return pathlib.Path(__file__).parent.joinpath(fname).read_text(encoding="utf-8")
 
 
 def tests():
@@ -40,5 +40,9 @@ setup(
   install_requires=[
     "pretty_midi >= 0.2.8",
     "bokeh >= 2.0.2",
-  ]
+    "numpy",
+  ],
+  extras_require={
+    "symusic": ["symusic"],
+  },
 )
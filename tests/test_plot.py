@@ -1,16 +1,43 @@
+import gzip
 import os
+import tempfile
 import unittest
+from unittest import mock
 
+import numpy as np
 import pretty_midi as pm
+from bokeh.models import GlyphRenderer
 from pretty_midi import TimeSignature
 
+try:
+    import symusic
+except ImportError:
+    symusic = None
+
 from presets import PRESET_4K
+from presets import Preset
 from visual_midi import Coloring
 from visual_midi.visual_midi import Plotter
 
 os.makedirs("output", exist_ok=True)
 
 
+def _get_bar_count(plot):
+    # The bars are the glyph spanning the whole MIDI pitch range
+    for renderer in plot.select(dict(type=GlyphRenderer)):
+        if getattr(renderer.glyph, "top", None) == Plotter._MAX_PITCH + 1:
+            return len(renderer.data_source.data["left"])
+    return 0
+
+
+def _get_notes_data(plot):
+    # The notes are the glyph with the color index column
+    for renderer in plot.select(dict(type=GlyphRenderer)):
+        if "color_index" in renderer.data_source.data:
+            return renderer.data_source.data
+    return {}
+
+
 class TestDefaultPlot(unittest.TestCase):
 
     def test_plotter_preset(self):
@@ -20,6 +47,17 @@ class TestDefaultPlot(unittest.TestCase):
         output_file = os.path.join("output", "test_plotter_preset.html")
         plotter.save(pretty_midi, output_file)
 
+    def test_webgl_plot(self):
+        plotter = Plotter(Preset(output_backend="webgl"))
+        pretty_midi = pm.PrettyMIDI()
+        pretty_midi.instruments.append(pm.Instrument(0))
+        notes = [pm.Note(100, 36, 1.5, 1.7)]
+        pretty_midi.instruments[0].notes = notes
+        plot = plotter.plot(pretty_midi)
+        self.assertEqual("webgl", plot.output_backend)
+        output_file = os.path.join("output", "test_webgl_plot.html")
+        plotter.save(pretty_midi, output_file)
+
     def test_empty_plot(self):
         plotter = Plotter()
         pretty_midi = pm.PrettyMIDI()
@@ -32,7 +70,7 @@ class TestDefaultPlot(unittest.TestCase):
         pretty_midi = pm.PrettyMIDI()
         pretty_midi.instruments.append(pm.Instrument(0))
         notes = [pm.Note(100, 36, 1.5, 1.7)]
-        [pretty_midi.instruments[0].notes.append(note) for note in notes]
+        pretty_midi.instruments[0].notes = notes
         plotter.plot(pretty_midi)
         output_file = os.path.join("output", "test_one_note_plot.html")
         plotter.save(pretty_midi, output_file)
@@ -43,11 +81,39 @@ class TestDefaultPlot(unittest.TestCase):
         pretty_midi.instruments.append(pm.Instrument(0))
         notes = [pm.Note(100, 36, 1.5, 1.7),
                  pm.Note(100, 37, 3.5, 4.0)]
-        [pretty_midi.instruments[0].notes.append(note) for note in notes]
+        pretty_midi.instruments[0].notes = notes
         plotter.plot(pretty_midi)
         output_file = os.path.join("output", "test_two_notes_plot.html")
         plotter.save(pretty_midi, output_file)
 
+    def test_end_near_bar_plot(self):
+        plotter = Plotter()
+        pretty_midi = pm.PrettyMIDI()
+        pretty_midi.instruments.append(pm.Instrument(0))
+        notes = [pm.Note(100, 36, 1.5, 4.0 - 1e-12)]
+        pretty_midi.instruments[0].notes = notes
+        plot = plotter.plot(pretty_midi)
+        self.assertEqual(4.0, plot.x_range.end)
+
+    def test_qpm_multiple_tempi(self):
+        plotter = Plotter()
+        with self.assertRaises(Exception) as context:
+            plotter._get_qpm((np.array([0.0, 1.0]), np.array([120.0, 150.0])))
+        self.assertIn("Multiple tempo changes", str(context.exception))
+        with self.assertRaises(Exception) as context:
+            plotter._get_qpm((np.array([0.0]), np.array([0.0])))
+        self.assertIn("Unknown qpm", str(context.exception))
+
+    def test_qpm_zero_tempi(self):
+        plotter = Plotter()
+        qpm = plotter._get_qpm((np.array([0.0, 1.0, 2.0]), np.array([0.0, 150.0, 0.0])))
+        self.assertEqual(150.0, qpm)
+
+    def test_qpm_float_noise_tempi(self):
+        plotter = Plotter()
+        qpm = plotter._get_qpm((np.array([0.0, 1.0]), np.array([120.0, 120.0 + 1e-9])))
+        self.assertEqual(120.0, qpm)
+
     def test_multiple_notes_plot(self):
         plotter = Plotter()
         pretty_midi = pm.PrettyMIDI()
@@ -58,7 +124,7 @@ class TestDefaultPlot(unittest.TestCase):
                  pm.Note(100, 39, 5.5, 6.0),
                  pm.Note(100, 40, 6.0, 7.0),
                  pm.Note(100, 41, 7.0, 8.0)]
-        [pretty_midi.instruments[0].notes.append(note) for note in notes]
+        pretty_midi.instruments[0].notes = notes
         plotter.plot(pretty_midi)
         output_file = os.path.join("output", "test_multiple_notes_plot.html")
         plotter.save(pretty_midi, output_file)
@@ -73,7 +139,7 @@ class TestDefaultPlot(unittest.TestCase):
                  pm.Note(100, 39, 5.5, 6.0),
                  pm.Note(100, 40, 6.0, 7.0),
                  pm.Note(100, 41, 7.0, 8.0)]
-        [pretty_midi.instruments[0].notes.append(note) for note in notes]
+        pretty_midi.instruments[0].notes = notes
         plotter.plot(pretty_midi)
         output_file = os.path.join("output", "test_qpm_plot.html")
         plotter.save(pretty_midi, output_file)
@@ -92,7 +158,7 @@ class TestDefaultPlot(unittest.TestCase):
                  pm.Note(100, 37, 9.5, 10.0),
                  pm.Note(100, 37, 10.0, 10.5),
                  pm.Note(100, 37, 10.5, 11.0)]
-        [pretty_midi.instruments[0].notes.append(note) for note in notes]
+        pretty_midi.instruments[0].notes = notes
         plotter.plot(pretty_midi)
         output_file = os.path.join("output", "test_overflow_plot.html")
         plotter.save(pretty_midi, output_file)
@@ -108,7 +174,7 @@ class TestDefaultPlot(unittest.TestCase):
                  pm.Note(100, 39, 5.5, 6.0),
                  pm.Note(100, 40, 6.0, 7.0),
                  pm.Note(100, 41, 7.0, 8.0)]
-        [pretty_midi.instruments[0].notes.append(note) for note in notes]
+        pretty_midi.instruments[0].notes = notes
         plotter.plot(pretty_midi)
         output_file = os.path.join("output", "test_time_signature_plot.html")
         plotter.save(pretty_midi, output_file)
@@ -124,17 +190,145 @@ class TestDefaultPlot(unittest.TestCase):
                  pm.Note(100, 39, 5.5, 6.0),
                  pm.Note(100, 40, 6.0, 7.0),
                  pm.Note(100, 41, 7.0, 8.0)]
-        [pretty_midi.instruments[0].notes.append(note) for note in notes]
+        pretty_midi.instruments[0].notes = notes
         # Instrument 1
         pretty_midi.instruments.append(pm.Instrument(1))
         notes = [pm.Note(100, 50, 1.5, 2.5),
                  pm.Note(100, 53, 3.5, 5.0),
                  pm.Note(100, 54, 5.0, 7.0)]
-        [pretty_midi.instruments[1].notes.append(note) for note in notes]
+        pretty_midi.instruments[1].notes = notes
         plotter.plot(pretty_midi)
         output_file = os.path.join("output", "test_instrument_color_plot.html")
         plotter.save(pretty_midi, output_file)
 
+    def test_save_gzip(self):
+        plotter = Plotter()
+        pretty_midi = pm.PrettyMIDI()
+        pretty_midi.instruments.append(pm.Instrument(0))
+        notes = [pm.Note(100, 36, 1.5, 1.7),
+                 pm.Note(100, 37, 3.5, 4.1)]
+        pretty_midi.instruments[0].notes = notes
+        output_file = os.path.join("output", "test_save_gzip.html.gz")
+        plotter.save(pretty_midi, output_file)
+        with gzip.open(output_file, "rt", encoding="utf-8") as file:
+            self.assertIn("</html>", file.read())
+
+    def test_show_gzip(self):
+        plotter = Plotter(live_reload=True)
+        pretty_midi = pm.PrettyMIDI()
+        output_file = os.path.join("output", "test_show_gzip.html.gz")
+        with self.assertRaises(Exception):
+            plotter.show(pretty_midi, output_file)
+        self.assertFalse(os.path.exists(output_file))
+
+    def test_save_many(self):
+        plotter = Plotter()
+        pretty_midis = []
+        output_files = []
+        for index in range(2):
+            pretty_midi = pm.PrettyMIDI()
+            pretty_midi.instruments.append(pm.Instrument(0))
+            notes = [pm.Note(100, 36 + index, 1.5, 1.7),
+                     pm.Note(100, 37 + index, 3.5, 4.1)]
+            pretty_midi.instruments[0].notes = notes
+            pretty_midis.append(pretty_midi)
+            output_files.append(os.path.join("output", "test_save_many_%s.html" % index))
+        plotter.save_many(pretty_midis, output_files)
+        for output_file in output_files:
+            self.assertTrue(os.path.exists(output_file))
+
+    def test_plot_path(self):
+        plotter = Plotter()
+        pretty_midi = pm.PrettyMIDI(initial_tempo=150)
+        pretty_midi.instruments.append(pm.Instrument(0))
+        pretty_midi.time_signature_changes.append(TimeSignature(3, 8, 0))
+        notes = [pm.Note(100, 36, 1.5, 1.7),
+                 pm.Note(100, 37, 3.5, 4.1)]
+        pretty_midi.instruments[0].notes = notes
+        midi_file = os.path.join("output", "test_plot_path.mid")
+        pretty_midi.write(midi_file)
+        plotter.plot_path(midi_file)
+
+    def test_plot_path_compound_meter(self):
+        plotter = Plotter()
+        pretty_midi = pm.PrettyMIDI(initial_tempo=90)
+        pretty_midi.instruments.append(pm.Instrument(0))
+        pretty_midi.time_signature_changes.append(TimeSignature(6, 8, 0))
+        notes = [pm.Note(100, 36, 1.5, 1.7),
+                 pm.Note(100, 37, 8.5, 10.0)]
+        pretty_midi.instruments[0].notes = notes
+        midi_file = os.path.join("output", "test_plot_path_compound_meter.mid")
+        pretty_midi.write(midi_file)
+        plot = plotter.plot(pm.PrettyMIDI(midi_file))
+        plot_path = plotter.plot_path(midi_file)
+        self.assertAlmostEqual(plot.x_range.start, plot_path.x_range.start)
+        self.assertAlmostEqual(plot.x_range.end, plot_path.x_range.end)
+        self.assertEqual(_get_bar_count(plot), _get_bar_count(plot_path))
+
+    def test_plot_path_cache(self):
+        pretty_midi = pm.PrettyMIDI(initial_tempo=90)
+        pretty_midi.instruments.append(pm.Instrument(0))
+        pretty_midi.instruments.append(pm.Instrument(1))
+        pretty_midi.time_signature_changes.append(TimeSignature(6, 8, 0))
+        notes = [pm.Note(100, 36, 1.5, 1.7),
+                 pm.Note(100, 37, 3.5, 4.1)]
+        pretty_midi.instruments[0].notes = notes
+        midi_file = os.path.join("output", "test_plot_path_cache.mid")
+        pretty_midi.write(midi_file)
+        plot = Plotter().plot(pm.PrettyMIDI(midi_file))
+        plot_caches = []
+        # Parses with symusic (if installed) and pretty midi on a cache miss
+        for parser in [symusic, None]:
+            with mock.patch("visual_midi.visual_midi.symusic", parser), \
+                    tempfile.TemporaryDirectory() as cache_dir:
+                plotter = Plotter(cache_dir=cache_dir)
+                plot_caches.append(plotter.plot_path(midi_file))
+                self.assertEqual(1, len([file for file in os.listdir(cache_dir) if file.endswith(".npz")]))
+                plot_caches.append(plotter.plot_path(midi_file))
+        for plot_cache in plot_caches:
+            self.assertAlmostEqual(plot.x_range.start, plot_cache.x_range.start)
+            self.assertAlmostEqual(plot.x_range.end, plot_cache.x_range.end)
+            self.assertEqual(plot.y_range.start, plot_cache.y_range.start)
+            self.assertEqual(plot.y_range.end, plot_cache.y_range.end)
+            self.assertEqual(plot.title.text, plot_cache.title.text)
+            self.assertEqual(_get_bar_count(plot), _get_bar_count(plot_cache))
+            notes, notes_cache = _get_notes_data(plot), _get_notes_data(plot_cache)
+            self.assertEqual(notes.keys(), notes_cache.keys())
+            for key in notes:
+                np.testing.assert_allclose(notes[key], notes_cache[key], atol=1e-5)
+
+    def test_plot_path_corrupted_cache(self):
+        pretty_midi = pm.PrettyMIDI()
+        pretty_midi.instruments.append(pm.Instrument(0))
+        notes = [pm.Note(100, 36, 1.5, 1.7)]
+        pretty_midi.instruments[0].notes = notes
+        midi_file = os.path.join("output", "test_plot_path_corrupted_cache.mid")
+        pretty_midi.write(midi_file)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            plotter = Plotter(cache_dir=cache_dir)
+            plotter.plot_path(midi_file)
+            cache_file = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+            with open(cache_file, "r+b") as file:
+                file.truncate(10)
+            plot = plotter.plot_path(midi_file)
+            self.assertEqual(2.0, plot.x_range.end)
+            self.assertEqual([os.path.basename(cache_file)], os.listdir(cache_dir))
+
+    @unittest.skipIf(symusic is None, "symusic is not installed")
+    def test_symusic_plot(self):
+        plotter = Plotter()
+        pretty_midi = pm.PrettyMIDI(initial_tempo=150)
+        pretty_midi.instruments.append(pm.Instrument(0))
+        notes = [pm.Note(100, 36, 1.5, 1.7),
+                 pm.Note(100, 37, 3.5, 4.1)]
+        pretty_midi.instruments[0].notes = notes
+        midi_file = os.path.join("output", "test_symusic_plot.mid")
+        pretty_midi.write(midi_file)
+        score = symusic.Score(midi_file)
+        plotter.plot(score)
+        output_file = os.path.join("output", "test_symusic_plot.html")
+        plotter.save(score, output_file)
+
 
 if __name__ == '__main__':
     unittest.main()
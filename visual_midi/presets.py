@@ -8,17 +8,46 @@ class Coloring(Enum):
 
     @staticmethod
     def from_name(name: str):
-        for color in Coloring:
-            if color.name == name:
-                return color
-        raise ValueError("Unknown color name: " + name)
+        # Enum name lookup is a dict lookup on the members mapping
+        try:
+            return Coloring[name]
+        except KeyError:
+            raise ValueError("Unknown color name: " + name) from None
 
 
 class Preset:
     """
     Preset class to configure the plotter bokeh plot output.
+
+    Setting the toolbar_location to None (like PRESET_4K) removes the
+    toolbar from the page, which gives the fastest rendering. Setting the
+    output_backend to "webgl" renders the notes on the GPU in bokeh versions
+    supporting it for quads (others fall back to the canvas).
+
+    Presets are immutable and hashable, so they can be shared between
+    plotters and used as cache keys.
     """
 
+    __slots__ = (
+        "plot_width",
+        "plot_height",
+        "row_height",
+        "show_bar",
+        "show_beat",
+        "title_text_font_size",
+        "axis_label_text_font_size",
+        "axis_x_major_tick_out",
+        "axis_y_major_tick_out",
+        "label_y_axis_offset_x",
+        "label_y_axis_offset_y",
+        "axis_y_label_standoff",
+        "label_text_font_size",
+        "label_text_font_style",
+        "toolbar_location",
+        "stop_live_reload_button",
+        "output_backend",
+    )
+
     def __init__(self,
                  plot_width: int = 1200,
                  plot_height: int = 400,
@@ -35,7 +64,8 @@ class Preset:
                  label_text_font_size: str = "10px",
                  label_text_font_style: str = "normal",
                  toolbar_location: Optional[str] = "right",
-                 stop_live_reload_button: bool = True):
+                 stop_live_reload_button: bool = True,
+                 output_backend: str = "canvas"):
         self.plot_width = plot_width
         self.plot_height = plot_height
         self.row_height = row_height
@@ -52,6 +82,24 @@ class Preset:
         self.label_text_font_style = label_text_font_style
         self.toolbar_location = toolbar_location
         self.stop_live_reload_button = stop_live_reload_button
+        self.output_backend = output_backend
+
+    def __setattr__(self, name, value):
+        # Each attribute can only be set once, in the constructor
+        if hasattr(self, name):
+            raise AttributeError("Preset is immutable, cannot set: " + name)
+        super().__setattr__(name, value)
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, Preset):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __hash__(self):
+        return hash(self._values())
 
 
 PRESET_DEFAULT = Preset()
@@ -3,34 +3,236 @@ Converts a pretty midi sequence to a boket plot
 """
 import argparse
 import ast
+import gzip
+import hashlib
 import math
 import os
 import sys
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from typing import List
 from typing import Tuple
 
 import bokeh
 import bokeh.plotting
+import numpy as np
 from bokeh.colors.groups import purple as colors
 from bokeh.embed import file_html
 from bokeh.io import output_file, output_notebook
 from bokeh.io import save
 from bokeh.io import show
 from bokeh.layouts import column
-from bokeh.models import BoxAnnotation
 from bokeh.models import ColumnDataSource
-from bokeh.models import Label
+from bokeh.models import LabelSet
 from bokeh.models import Range1d
 from bokeh.models import Title
 from bokeh.models.callbacks import CustomJS
 from bokeh.models.widgets.buttons import Button
 from bokeh.resources import CDN
+from bokeh.transform import linear_cmap
 from pretty_midi import PrettyMIDI
 from pretty_midi import TimeSignature
+from pretty_midi import qpm_to_bpm
 
 from .presets import Coloring
+from .presets import PRESET_DEFAULT
 from .presets import Preset
 
+try:
+    import symusic
+except ImportError:
+    symusic = None
+
+# The note colors palette, lightened once here instead of for each note,
+# the notes only refer to the palette with their color index
+_PALETTE = tuple(color.lighten(0.1).to_hex() for color in colors)
+_N_COLORS = len(_PALETTE)
+
+
+class _InstrumentArrays:
+    """
+    Instrument with its notes stored as parallel arrays, one per note
+    property.
+    """
+
+    def __init__(self,
+                 program: int,
+                 starts: np.ndarray,
+                 ends: np.ndarray,
+                 pitches: np.ndarray,
+                 velocities: np.ndarray):
+        self.program = program
+        self.starts = starts
+        self.ends = ends
+        self.pitches = pitches
+        self.velocities = velocities
+
+
+class _MidiArrays:
+    """
+    MIDI content stored as note arrays per instrument, exposing the subset
+    of the PrettyMIDI interface used by the plotter, with all times in
+    seconds. Can be built from a symusic score or a pretty midi object, and
+    saved to (or loaded from) a npz file. The beats and downbeats are
+    stored, so that the ones computed by pretty midi are kept.
+    """
+
+    _DEFAULT_QPM = 120.0
+
+    def __init__(self,
+                 instruments: List[_InstrumentArrays],
+                 tempo_times: np.ndarray,
+                 tempi: np.ndarray,
+                 time_signature_changes: List[TimeSignature],
+                 end_time: float,
+                 beats: np.ndarray,
+                 downbeats: np.ndarray):
+        self.instruments = instruments
+        self.time_signature_changes = time_signature_changes
+        self._tempo_times = tempo_times
+        self._tempi = tempi
+        self._end_time = end_time
+        self._beats = beats
+        self._downbeats = downbeats
+
+    @staticmethod
+    def from_score(score):
+        score = score.to("second")
+        instruments = []
+        for track in score.tracks:
+            arrays = track.notes.numpy()
+            starts = arrays["time"].astype(np.float64)
+            ends = starts + arrays["duration"]
+            instruments.append(_InstrumentArrays(track.program,
+                                                 starts,
+                                                 ends,
+                                                 arrays["pitch"].astype(np.int16),
+                                                 arrays["velocity"].astype(np.int16)))
+        if score.tempos:
+            tempo_times = np.array([tempo.time for tempo in score.tempos])
+            tempi = np.array([tempo.qpm for tempo in score.tempos])
+        else:
+            tempo_times = np.array([0.0])
+            tempi = np.array([_MidiArrays._DEFAULT_QPM])
+        time_signatures = [TimeSignature(time_signature.numerator,
+                                         time_signature.denominator,
+                                         time_signature.time)
+                           for time_signature in score.time_signatures]
+        end_time = score.end()
+
+        # Only the first tempo and time signature are considered, since the
+        # plotter doesn't support multiple tempo or time signature changes,
+        # the beat length follows the pretty midi rule (the compound meters
+        # like 6/8 are counted in dotted quarter notes). Unlike pretty midi,
+        # a time signature starting after 0 is used from the start
+        bpm = float(tempi[0])
+        numerator = 4
+        if time_signatures:
+            time_signature = time_signatures[0]
+            bpm = qpm_to_bpm(bpm, time_signature.numerator, time_signature.denominator)
+            numerator = time_signature.numerator
+        beats = np.arange(0, end_time, 60.0 / bpm)
+        return _MidiArrays(instruments, tempo_times, tempi, time_signatures, end_time,
+                           beats, beats[::numerator])
+
+    @staticmethod
+    def from_pretty_midi(pm: PrettyMIDI):
+        instruments = [_InstrumentArrays(instrument.program, *_get_note_arrays(instrument))
+                       for instrument in pm.instruments]
+        tempo_times, tempi = pm.get_tempo_changes()
+        return _MidiArrays(instruments, tempo_times, tempi,
+                           list(pm.time_signature_changes), pm.get_end_time(),
+                           pm.get_beats(), pm.get_downbeats())
+
+    @staticmethod
+    def load(filepath: str):
+        with np.load(filepath) as arrays:
+            splits = np.cumsum(arrays["counts"])[:-1]
+            instruments = [_InstrumentArrays(int(program), starts, ends, pitches, velocities)
+                           for program, starts, ends, pitches, velocities
+                           in zip(arrays["programs"],
+                                  np.split(arrays["starts"], splits),
+                                  np.split(arrays["ends"], splits),
+                                  np.split(arrays["pitches"], splits),
+                                  np.split(arrays["velocities"], splits))]
+            time_signatures = [TimeSignature(int(numerator), int(denominator), float(time))
+                               for numerator, denominator, time in arrays["time_signatures"]]
+            return _MidiArrays(instruments, arrays["tempo_times"], arrays["tempi"],
+                               time_signatures, float(arrays["end_time"]),
+                               arrays["beats"], arrays["downbeats"])
+
+    def save(self, file):
+        instruments = self.instruments
+        time_signatures = [(time_signature.numerator, time_signature.denominator, time_signature.time)
+                           for time_signature in self.time_signature_changes]
+        np.savez(file,
+                 programs=np.array([instrument.program for instrument in instruments], dtype=np.int16),
+                 counts=np.array([len(instrument.pitches) for instrument in instruments], dtype=np.int64),
+                 starts=np.concatenate([i.starts for i in instruments] or [np.empty(0, dtype=np.float64)]),
+                 ends=np.concatenate([i.ends for i in instruments] or [np.empty(0, dtype=np.float64)]),
+                 pitches=np.concatenate([i.pitches for i in instruments] or [np.empty(0, dtype=np.int16)]),
+                 velocities=np.concatenate([i.velocities for i in instruments] or [np.empty(0, dtype=np.int16)]),
+                 tempo_times=self._tempo_times,
+                 tempi=self._tempi,
+                 time_signatures=np.array(time_signatures, dtype=np.float64).reshape(-1, 3),
+                 end_time=np.array(self._end_time),
+                 beats=self._beats,
+                 downbeats=self._downbeats)
+
+    def get_end_time(self):
+        return self._end_time
+
+    def get_tempo_changes(self):
+        return self._tempo_times, self._tempi
+
+    def get_beats(self):
+        return self._beats
+
+    def get_downbeats(self):
+        return self._downbeats
+
+
+_LIVE_RELOAD_SCRIPT = """
+              <script type="text/javascript">
+                var liveReloadInterval = window.setInterval(function(){
+                  location.reload();
+                }, 2000);
+              </script>
+              """
+
+
+def _get_note_arrays(instrument) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the start times, end times, pitches and velocities of the
+    instrument notes as arrays, the pretty midi instruments notes are read
+    into each array with np.fromiter (one pass per note property, without
+    intermediate lists).
+    """
+    if isinstance(instrument, _InstrumentArrays):
+        return instrument.starts, instrument.ends, instrument.pitches, instrument.velocities
+    notes = instrument.notes
+    count = len(notes)
+    starts = np.fromiter((note.start for note in notes), dtype=np.float64, count=count)
+    ends = np.fromiter((note.end for note in notes), dtype=np.float64, count=count)
+    pitches = np.fromiter((note.pitch for note in notes), dtype=np.int16, count=count)
+    velocities = np.fromiter((note.velocity for note in notes), dtype=np.int16, count=count)
+    return starts, ends, pitches, velocities
+
+
+def _open_html(filepath: str):
+    """
+    Opens the html file for writing in binary mode (the html is encoded
+    once in utf-8 by the caller, instead of going through the text io
+    layer), gzip compressed if the file path ends with ".gz" (the lowest
+    compression level is much faster than the default and compresses the
+    html almost as well).
+    """
+    if filepath.endswith(".gz"):
+        return gzip.open(filepath, "wb", compresslevel=1)
+    return open(filepath, "wb")
+
 
 class Plotter:
     """
@@ -54,9 +256,11 @@ class Plotter:
                  coloring: Coloring = Coloring.PITCH,
                  show_velocity: bool = False,
                  midi_time_signature: str = None,
-                 live_reload: bool = False):
+                 live_reload: bool = False,
+                 cache_dir: str = None):
         if not preset:
-            preset = Preset()
+            # Presets are immutable, so the default one can be shared
+            preset = PRESET_DEFAULT
         if not bar_fill_alphas:
             bar_fill_alphas = [0.25, 0.05]
         self._preset = preset
@@ -72,61 +276,118 @@ class Plotter:
         self._show_velocity = show_velocity
         self._midi_time_signature = midi_time_signature
         self._live_reload = live_reload
+        self._cache_dir = cache_dir
         self._show_counter = 0
 
-    def _get_qpm(self, pm: PrettyMIDI):
+    def _get_qpm(self, tempo_changes: Tuple[np.ndarray, np.ndarray]):
         """
-        Returns the first tempo change that is not zero, raises exception
-        if not found or multiple tempo present.
+        Returns the tempo of the tempo changes (times, tempi) that is not
+        zero, raises exception if not found or multiple tempo present. Tempi
+        that only differ by float noise are considered the same tempo.
         """
         if self._qpm:
             return self._qpm
-        qpm = None
-        for tempo_change in pm.get_tempo_changes():
-            if tempo_change.min() and tempo_change.max() and tempo_change.min() == tempo_change.max():
-                if qpm:
-                    raise Exception("Multiple tempo changes are not supported "
-                                    + str(pm.get_tempo_changes()))
-                qpm = tempo_change.min()
-        if not qpm:
+        _, tempi = tempo_changes
+        tempi = tempi[tempi > 0]
+        if tempi.size == 0:
             raise Exception("Unknown qpm in: "
-                            + str(pm.get_tempo_changes()))
-        return qpm
+                            + str(tempo_changes))
+        if not np.allclose(tempi, tempi[0]):
+            raise Exception("Multiple tempo changes are not supported "
+                            + str(tempo_changes))
+        return float(tempi[0])
 
-    def _get_color(self, index_instrument, note):
+    def _get_color_index(self, index_instrument, pitch):
         """
-        Returns the color for the instrument and the note, depends
-        on self._coloring.
+        Returns the color index in the palette for the instrument and the
+        note pitch (or pitches array), depends on self._coloring. The pitch
+        isn't used (and can be None) for the instrument coloring.
         """
         if self._coloring is Coloring.PITCH:
-            color_index = (note.pitch - 36) % len(colors)
+            color_index = (pitch - 36) % _N_COLORS
         elif self._coloring is Coloring.INSTRUMENT:
-            color_index = ((index_instrument + 1) * 5) % len(colors)
+            color_index = ((index_instrument + 1) * 5) % _N_COLORS
         else:
             raise Exception("Unknown coloring: " + str(self._coloring))
-        color = colors[color_index]
-        color = color.lighten(0.1)
-        return color
+        return color_index
+
+    def _load_midi(self, filepath: str):
+        """
+        Loads the MIDI file using symusic if it is installed (much faster), or
+        pretty midi otherwise. If a cache directory is configured, the notes
+        arrays are saved in it, keyed by the MIDI file content hash, and
+        loaded from it on the next calls instead of parsing the file.
+        """
+        if not self._cache_dir:
+            if symusic:
+                return symusic.Score(filepath)
+            return PrettyMIDI(filepath)
+        with open(filepath, "rb") as file:
+            digest = hashlib.md5(file.read()).hexdigest()
+        cache_file = os.path.join(self._cache_dir, digest + ".npz")
+        if os.path.exists(cache_file):
+            try:
+                return _MidiArrays.load(cache_file)
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                # A corrupted (or older) cache file is parsed again
+                pass
+        if symusic:
+            midi = _MidiArrays.from_score(symusic.Score(filepath))
+        else:
+            midi = _MidiArrays.from_pretty_midi(PrettyMIDI(filepath))
+        # Writes to a temporary file, then moves it in place, so that an
+        # interrupted write (or another process reading the same file)
+        # never sees a partial cache file
+        os.makedirs(self._cache_dir, exist_ok=True)
+        file_descriptor, temp_file = tempfile.mkstemp(suffix=".npz", dir=self._cache_dir)
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                midi.save(file)
+            os.replace(temp_file, cache_file)
+        except BaseException:
+            os.remove(temp_file)
+            raise
+        return midi
+
+    def plot_path(self, filepath: str):
+        """
+        Plots the MIDI file as a plot object, using symusic to parse the file
+        if it is installed (much faster), or pretty midi otherwise.
+
+          :param filepath: the MIDI file path to plot
+          :return: the bokeh plot layout
+        """
+        return self.plot(self._load_midi(filepath))
 
     def plot(self, pm: PrettyMIDI):
         """
         Plots the pretty midi object as a plot object.
 
-          :param pm: the PrettyMIDI instance to plot
+          :param pm: the PrettyMIDI instance (or symusic score) to plot
           :return: the bokeh plot layout
         """
+        if symusic and isinstance(pm, symusic.Score):
+            pm = _MidiArrays.from_score(pm)
+
         preset = self._preset
 
+        # Gets the tempo changes, beats and downbeats once, since pretty midi
+        # computes them again from the MIDI events on each call
+        tempo_changes = pm.get_tempo_changes()
+        beats = pm.get_beats()
+        downbeats = pm.get_downbeats()
+
         # Calculates the QPM from the MIDI file, might raise exception if confused
-        qpm = self._get_qpm(pm)
+        qpm = self._get_qpm(tempo_changes)
 
         # Initialize the tools, those are present on the right hand side
         plot = bokeh.plotting.figure(
             tools="reset,hover,save,wheel_zoom,pan",
-            toolbar_location=preset.toolbar_location)
+            toolbar_location=preset.toolbar_location,
+            output_backend=preset.output_backend)
 
-        # Setup the hover and the data dict for bokeh,
-        # each property must match a property in the data dict
+        # Setup the hover for bokeh, each property must match
+        # a property in the data dict
         plot.select(dict(type=bokeh.models.HoverTool)).tooltips = ({
             "program": "@program",
             "pitch": "@top",
@@ -134,47 +395,59 @@ class Plotter:
             "duration": "@duration",
             "start_time": "@left",
             "end_time": "@right"})
+
+        # Extracts the notes of each instrument as arrays (one per note
+        # property) and concatenates them for all instruments
+        programs = []
+        pitches = []
+        starts = []
+        ends = []
+        velocities = []
+        color_indexes = []
+        for index_instrument, instrument in enumerate(pm.instruments):
+            instrument_starts, instrument_ends, instrument_pitches, instrument_velocities = \
+                _get_note_arrays(instrument)
+            programs.append(np.full(len(instrument_pitches), instrument.program, dtype=np.int16))
+            pitches.append(instrument_pitches)
+            starts.append(instrument_starts)
+            ends.append(instrument_ends)
+            velocities.append(instrument_velocities)
+            # The instrument coloring gives a single index for all the notes
+            color_index = self._get_color_index(index_instrument, instrument_pitches)
+            color_indexes.append(np.broadcast_to(color_index, instrument_pitches.shape).astype(np.int8))
+        programs = np.concatenate(programs or [np.empty(0, dtype=np.int16)])
+        pitches = np.concatenate(pitches or [np.empty(0, dtype=np.int16)])
+        starts = np.concatenate(starts or [np.empty(0, dtype=np.float64)])
+        ends = np.concatenate(ends or [np.empty(0, dtype=np.float64)])
+        velocities = np.concatenate(velocities or [np.empty(0, dtype=np.int16)])
+        color_indexes = np.concatenate(color_indexes or [np.empty(0, dtype=np.int8)])
+
+        # Puts the notes in the dict for bokeh, the MIDI values (0 to 127,
+        # or 128 for the bottoms) fit in uint8 typed arrays, and the bottoms
+        # with velocity are only drawn, not shown in the hover, so they can
+        # be float32 (the times stay float64 for the hover values)
+        if self._show_velocity:
+            bottoms = (pitches + (velocities / 127)).astype(np.float32)
+        else:
+            bottoms = (pitches + 1).astype(np.uint8)
         data = dict(
-            program=[],
-            top=[],
-            bottom=[],
-            left=[],
-            right=[],
-            duration=[],
-            velocity=[],
-            color=[])
-
-        # Puts the notes in the dict for bokeh and saves first
-        # and last note time, bigger and smaller pitch
-        pitch_min = None
-        pitch_max = None
-        first_note_start = None
-        last_note_end = None
-        index_instrument = 0
-        for instrument in pm.instruments:
-            for note in instrument.notes:
-                pitch_min = min(pitch_min or self._MAX_PITCH, note.pitch)
-                pitch_max = max(pitch_max or self._MIN_PITCH, note.pitch)
-                color = self._get_color(index_instrument, note)
-                note_start = note.start
-                note_end = note.start + (note.end - note.start)
-                data["program"].append(instrument.program)
-                data["top"].append(note.pitch)
-                if self._show_velocity:
-                    data["bottom"].append(note.pitch + (note.velocity / 127))
-                else:
-                    data["bottom"].append(note.pitch + 1)
-                data["left"].append(note_start)
-                data["right"].append(note_end)
-                data["duration"].append(note_end - note_start)
-                data["velocity"].append(note.velocity)
-                data["color"].append(color)
-                first_note_start = min(first_note_start or sys.maxsize, note_start)
-                last_note_end = max(last_note_end or 0, note_end)
-            index_instrument = index_instrument + 1
-
-        # Shows an empty plot even if there are no notes
-        if first_note_start is None or last_note_end is None or pitch_min is None or pitch_max is None:
+            program=programs.astype(np.uint8),
+            top=pitches.astype(np.uint8),
+            bottom=bottoms,
+            left=starts,
+            right=ends,
+            duration=ends - starts,
+            velocity=velocities.astype(np.uint8),
+            color_index=color_indexes)
+
+        # Saves first and last note time, bigger and smaller pitch, or
+        # shows an empty plot if there are no notes
+        if pitches.size:
+            pitch_min = int(pitches.min())
+            pitch_max = int(pitches.max())
+            first_note_start = float(starts.min())
+            last_note_end = float(ends.max())
+        else:
             pitch_min = self._MIN_PITCH
             pitch_max = pitch_min + 5
             first_note_start = 0
@@ -193,42 +466,23 @@ class Plotter:
 
         pitch_range = pitch_max + 1 - pitch_min
 
-        # Draws the rectangles on the plot from the data
-        source = ColumnDataSource(data=data)
-        plot.quad(left="left",
-                  right="right",
-                  top="top",
-                  bottom="bottom",
-                  line_alpha=1,
-                  line_color="black",
-                  color="color",
-                  source=source)
-
-        # Draws the y grid by hand, because the grid has label on the ticks, but
-        # for a plot like this, the labels needs to fit in between the ticks.
-        # Also useful to change the background of the grid each line
-        for pitch in range(pitch_min, pitch_max + 1):
-            # Draws the background box and contours, on the underlay layer, so
-            # that the rectangles and over the box annotations
-            fill_alpha = (0.15 if pitch % 2 == 0 else 0.00)
-            box = BoxAnnotation(bottom=pitch,
-                                top=pitch + 1,
-                                fill_color="gray",
-                                fill_alpha=fill_alpha,
-                                line_color="black",
-                                line_alpha=0.3,
-                                line_width=1,
-                                level="underlay")
-            plot.add_layout(box)
-            label = Label(
-                x=preset.label_y_axis_offset_x,
-                y=pitch + preset.label_y_axis_offset_y,
-                x_units="screen",
-                text=str(pitch),
-                render_mode="css",
-                text_font_size=preset.label_text_font_size,
-                text_font_style=preset.label_text_font_style)
-            plot.add_layout(label)
+        # Draws the rectangles on the plot from the data, an empty plot
+        # has no data source nor glyph, only the axes and grid. The hover
+        # only shows the notes, not the grid glyphs
+        hover_renderers = []
+        if pitches.size:
+            source = ColumnDataSource(data=data)
+            notes_renderer = plot.quad(left="left",
+                                       right="right",
+                                       top="top",
+                                       bottom="bottom",
+                                       line_alpha=1,
+                                       line_color="black",
+                                       fill_color=linear_cmap("color_index", _PALETTE,
+                                                              -0.5, _N_COLORS - 0.5),
+                                       source=source)
+            hover_renderers.append(notes_renderer)
+        plot.select(dict(type=bokeh.models.HoverTool)).renderers = hover_renderers
 
         # Gets the time signature from pretty midi, or 4/4 if none
         if self._midi_time_signature:
@@ -243,12 +497,12 @@ class Plotter:
                 time_signature = TimeSignature(4, 4, 0)
 
         # Gets seconds per bar and seconds per beat
-        if len(pm.get_beats()) >= 2:
-            seconds_per_beat = pm.get_beats()[1] - pm.get_beats()[0]
+        if len(beats) >= 2:
+            seconds_per_beat = beats[1] - beats[0]
         else:
             seconds_per_beat = 0.5
-        if len(pm.get_downbeats()) >= 2:
-            seconds_per_bar = pm.get_downbeats()[1] - pm.get_downbeats()[0]
+        if len(downbeats) >= 2:
+            seconds_per_bar = downbeats[1] - downbeats[0]
         else:
             seconds_per_bar = 2.0
 
@@ -263,10 +517,9 @@ class Plotter:
             # smaller value for the start time, closest higher value for the end time)
             plot_end_time = int((last_note_end) / seconds_per_bar) * seconds_per_bar
             # If the last note end is exactly on a multiple of seconds per bar,
-            # we don't start a new one
-            is_on_bar = math.isclose(last_note_end % seconds_per_bar, seconds_per_bar)
-            is_on_bar_exact = math.isclose(last_note_end % seconds_per_bar, 0.0)
-            if not is_on_bar and not is_on_bar_exact:
+            # we don't start a new one (a remainder close to seconds per bar
+            # is a float error just before the bar, which needs the new one)
+            if not math.isclose(math.fmod(last_note_end, seconds_per_bar), 0.0):
                 plot_end_time += seconds_per_bar
 
         # Defines the start time of the plot in seconds
@@ -277,35 +530,80 @@ class Plotter:
             plot_max_length_time = self._plot_max_length_bar * seconds_per_bar
             plot_start_time = max(plot_end_time - plot_max_length_time, start_time)
 
+        # The grid glyphs have finite bounds (unlike the box annotations), so
+        # they span the whole song, or the visible range if it is bigger
+        grid_start_time = min(0, plot_start_time)
+        grid_end_time = max(plot_end_time, last_note_end)
+        if len(downbeats):
+            grid_end_time = max(grid_end_time, downbeats[-1] + seconds_per_bar)
+
+        # Draws the y grid by hand, because the grid has label on the ticks, but
+        # for a plot like this, the labels needs to fit in between the ticks.
+        # Also useful to change the background of the grid each line. The
+        # rows are drawn as a single glyph on the underlay layer, so that
+        # the notes are drawn over them
+        row_pitches = np.arange(pitch_min, pitch_max + 1)
+        row_source = ColumnDataSource(data=dict(
+            bottom=row_pitches,
+            top=row_pitches + 1,
+            fill_alpha=np.where(row_pitches % 2 == 0, 0.15, 0.00)))
+        plot.quad(left=grid_start_time,
+                  right=grid_end_time,
+                  top="top",
+                  bottom="bottom",
+                  fill_color="gray",
+                  fill_alpha="fill_alpha",
+                  line_color="black",
+                  line_alpha=0.3,
+                  line_width=1,
+                  level="underlay",
+                  source=row_source)
+        label_source = ColumnDataSource(data=dict(
+            y=row_pitches + preset.label_y_axis_offset_y,
+            text=[str(pitch) for pitch in row_pitches.tolist()]))
+        plot.add_layout(LabelSet(
+            x=preset.label_y_axis_offset_x,
+            y="y",
+            x_units="screen",
+            text="text",
+            render_mode="css",
+            text_font_size=preset.label_text_font_size,
+            text_font_style=preset.label_text_font_style,
+            source=label_source))
+
         # Draws the vertical bar grid, with a different background color
-        # for each bar
-        if preset.show_bar:
-            bar_count = 0
-            for bar_time in pm.get_downbeats():
-                fill_alpha_index = bar_count % len(self._bar_fill_alphas)
-                fill_alpha = self._bar_fill_alphas[fill_alpha_index]
-                box = BoxAnnotation(left=bar_time,
-                                    right=bar_time + seconds_per_bar,
-                                    fill_color="gray",
-                                    fill_alpha=fill_alpha,
-                                    line_color="black",
-                                    line_width=2,
-                                    line_alpha=0.5,
-                                    level="underlay")
-                plot.add_layout(box)
-                bar_count += 1
-
-        # Draws the vertical beat grid, those are only grid lines
-        if preset.show_beat:
-            for beat_time in pm.get_beats():
-                box = BoxAnnotation(left=beat_time,
-                                    right=beat_time + seconds_per_beat,
-                                    fill_color=None,
-                                    line_color="black",
-                                    line_width=1,
-                                    line_alpha=0.4,
-                                    level="underlay")
-                plot.add_layout(box)
+        # for each bar, as a single glyph covering the whole pitch range
+        if preset.show_bar and len(downbeats):
+            bar_fill_alphas = np.asarray(self._bar_fill_alphas, dtype=np.float64)
+            bar_source = ColumnDataSource(data=dict(
+                left=downbeats,
+                right=downbeats + seconds_per_bar,
+                fill_alpha=bar_fill_alphas[np.arange(len(downbeats)) % len(bar_fill_alphas)]))
+            plot.quad(left="left",
+                      right="right",
+                      top=self._MAX_PITCH + 1,
+                      bottom=self._MIN_PITCH,
+                      fill_color="gray",
+                      fill_alpha="fill_alpha",
+                      line_color="black",
+                      line_width=2,
+                      line_alpha=0.5,
+                      level="underlay",
+                      source=bar_source)
+
+        # Draws the vertical beat grid, those are only grid lines (one at
+        # the start of each beat, plus the end of the last beat), as a single
+        # segment glyph covering the whole pitch range
+        if preset.show_beat and len(beats):
+            beat_times = np.append(beats, beats[-1] + seconds_per_beat)
+            plot.segment(x0=beat_times,
+                         y0=self._MIN_PITCH,
+                         x1=beat_times,
+                         y1=self._MAX_PITCH + 1,
+                         line_color="black",
+                         line_width=1,
+                         line_alpha=0.4,
+                         level="underlay")
 
         # Configure x axis
         plot.xaxis.bounds = (plot_start_time, plot_end_time)
@@ -364,15 +662,27 @@ class Plotter:
             button.js_on_click(callback)
             layout = column(button, plot)
         else:
-            layout = column(plot)
+            # The figure is returned without a layout wrapper, which avoids
+            # an extra level of layout computation when rendering the page
+            layout = plot
 
         return layout
 
+    def _write_live_reload_html(self, plot, filepath: str):
+        # Writes the html around the live reload script, instead of
+        # replacing in (and copying) the whole html string
+        head, head_end, body = file_html(plot, CDN).partition("</head>")
+        with _open_html(filepath) as file:
+            file.write(head.encode("utf-8"))
+            file.write(_LIVE_RELOAD_SCRIPT.encode("utf-8"))
+            file.write(head_end.encode("utf-8"))
+            file.write(body.encode("utf-8"))
+
     def save(self, pm: PrettyMIDI, filepath: str):
         """
         Saves the pretty midi object as a plot file (html) in the provided file. If
         the live reload option is activated, the opened page will periodically
-        refresh.
+        refresh. If the file path ends with ".gz", the html is gzip compressed.
 
           :param pm: the PrettyMIDI instance to plot
           :param filepath: the file path to save the resulting plot to
@@ -380,48 +690,50 @@ class Plotter:
         """
         plot = self.plot(pm)
         if self._live_reload:
-            html = file_html(plot, CDN)
-            html = html.replace("</head>", """
-              <script type="text/javascript">
-                var liveReloadInterval = window.setInterval(function(){
-                  location.reload();
-                }, 2000);
-              </script>
-              </head>""")
-            with open(filepath, 'w') as file:
-                file.write(html)
+            self._write_live_reload_html(plot, filepath)
+        elif filepath.endswith(".gz"):
+            with _open_html(filepath) as file:
+                file.write(file_html(plot, CDN).encode("utf-8"))
         else:
-            output_file(filepath)
+            output_file(filepath, mode="cdn")
             save(plot)
         return plot
 
+    def save_many(self, pms: List[PrettyMIDI], filepaths: List[str], max_workers: int = None):
+        """
+        Saves each pretty midi object as a plot file (html) in its provided
+        file, like save, rendering the plots in parallel worker processes
+        (threads wouldn't help since plotting is CPU bound python code).
+
+          :param pms: the PrettyMIDI instances to plot
+          :param filepaths: the file paths to save the resulting plots to
+          :param max_workers: the number of worker processes, defaults to
+            the number of processors on the machine
+        """
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(_save_plot, repeat(self), pms, filepaths))
+
     def show(self, pm: PrettyMIDI, filepath: str):
         """
         Shows the pretty midi object as a plot file (html) in the browser. If
         the live reload option is activated, the opened page will periodically
-        refresh.
+        refresh. The file can't be gzip compressed (like in save), since the
+        browsers don't decompress local files.
 
           :param pm: the PrettyMIDI instance to plot
           :param filepath: the file path to save the resulting plot to
           :return: the bokeh plot layout
         """
+        if filepath.endswith(".gz"):
+            raise Exception("Gzip compressed files can't be shown: " + filepath)
         plot = self.plot(pm)
         if self._live_reload:
-            html = file_html(plot, CDN)
-            html = html.replace("</head>", """
-              <script type="text/javascript">
-                var liveReloadInterval = window.setInterval(function(){
-                  location.reload();
-                }, 2000);
-              </script>
-              </head>""")
-            with open(filepath, 'w') as file:
-                file.write(html)
+            self._write_live_reload_html(plot, filepath)
             if self._show_counter == 0:
                 import webbrowser
                 webbrowser.open("file://" + os.path.realpath(filepath), new=2)
         else:
-            output_file(filepath)
+            output_file(filepath, mode="cdn")
             show(plot)
         self._show_counter += 1
         return plot
@@ -439,6 +751,19 @@ class Plotter:
         return plot
 
 
+def _save_plot(plotter: Plotter, pm: PrettyMIDI, filepath: str):
+    # Doesn't return the plot layout, to avoid sending bokeh models
+    # back from the worker processes
+    plotter.save(pm, filepath)
+
+
+def _save_midi_file(plotter: Plotter, midi_file: str):
+    # Loads with symusic if installed (or pretty midi), like plot_path
+    plot_file = midi_file.replace(".mid", ".html")
+    print("Plotting midi file " + midi_file + " to " + plot_file)
+    plotter.save(plotter._load_midi(midi_file), plot_file)
+
+
 def console_entry_point():
     flags_plot = [
         ("qpm", int),
@@ -453,6 +778,7 @@ def console_entry_point():
         ("show_velocity", str, ast.literal_eval),
         ("midi_time_signature", str),
         ("live_reload", str, ast.literal_eval),
+        ("cache_dir", str),
     ]
     flags_preset = [
         ("plot_width", int),
@@ -471,15 +797,18 @@ def console_entry_point():
         ("label_text_font_style", str),
         ("toolbar_location", str),
         ("stop_live_reload_button", str, ast.literal_eval),
+        ("output_backend", str),
     ]
     parser = argparse.ArgumentParser()
-    [parser.add_argument("--" + flag[0], type=flag[1]) for flag in flags_plot]
-    [parser.add_argument("--" + flag[0], type=flag[1]) for flag in flags_preset]
+    for flag in flags_plot:
+        parser.add_argument("--" + flag[0], type=flag[1])
+    for flag in flags_preset:
+        parser.add_argument("--" + flag[0], type=flag[1])
     parser.add_argument("files", type=str, nargs='+')
     args = parser.parse_args()
 
-    def _eval_parser_arg(flag: Tuple):
-        value = None if getattr(args, flag[0]) == "None" else getattr(args, flag[0])
+    def _eval_parser_arg(flag: Tuple, value):
+        value = None if value == "None" else value
         if not value:
             return None
         if len(flag) == 3:
@@ -491,21 +820,29 @@ def console_entry_point():
                                 + "' with value '" + str(value) + "'")
         return value
 
-    kwargs_preset = {flag[0]: _eval_parser_arg(flag)
-                     for flag in flags_preset
-                     if getattr(args, flag[0], None)}
+    def _eval_parser_args(flags: List[Tuple]):
+        # Gets each flag value once, skipping the flags not provided
+        kwargs = {}
+        for flag in flags:
+            value = getattr(args, flag[0], None)
+            if value:
+                kwargs[flag[0]] = _eval_parser_arg(flag, value)
+        return kwargs
+
+    kwargs_preset = _eval_parser_args(flags_preset)
     preset = Preset(**kwargs_preset)
 
-    kwargs_plotter = {flag[0]: _eval_parser_arg(flag)
-                      for flag in flags_plot
-                      if getattr(args, flag[0], None)}
+    kwargs_plotter = _eval_parser_args(flags_plot)
     plotter = Plotter(preset=preset, **kwargs_plotter)
 
-    for midi_file in args.files:
-        plot_file = midi_file.replace(".mid", ".html")
-        print("Plotting midi file " + midi_file + " to " + plot_file)
-        pretty_midi = PrettyMIDI(midi_file)
-        plotter.save(pretty_midi, plot_file)
+    # The files are independent and plotting is CPU bound, so multiple
+    # files are parsed and plotted in parallel worker processes
+    if len(args.files) > 1:
+        with ProcessPoolExecutor() as executor:
+            list(executor.map(_save_midi_file, repeat(plotter), args.files))
+    else:
+        for midi_file in args.files:
+            _save_midi_file(plotter, midi_file)
     sys.exit(0)
 
 